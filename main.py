@@ -1,10 +1,12 @@
-from bs4 import BeautifulSoup, Tag, NavigableString, Comment
-from datasketch import MinHash, MinHashLSH
+from bs4 import BeautifulSoup, Tag, NavigableString
+from lxml import etree
+from lxml.html import fragment_fromstring
+from datasketch import MinHash, MinHashLSH, LeanMinHash
 from simhash import Simhash
-from zss import simple_distance, Node
 from pathlib import Path
-from collections import defaultdict
-import re, json, os
+from collections import defaultdict, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import re, json, os, hashlib
 
 
 def write_partial(dir_path: Path, filename: str, content):
@@ -14,6 +16,10 @@ def write_partial(dir_path: Path, filename: str, content):
     print(f"   📄 Created partial: {path}")
 
 
+def write_page(path: Path, soup):
+    path.write_text(soup.prettify(), encoding="utf-8")
+
+
 def create_include_statement(filename: str, params: dict = None) -> str:
     if params is None or not any(params.values()):
         return f"@@include('./partials/{filename}')"
@@ -30,9 +36,14 @@ class HtmlRefactorer:
     PRIORITY_TAGS = ["header", "nav", "footer", "aside"]
     PARAMETERIZE_TAGS = ['h1', 'h2', 'h3', 'h4', 'a', 'img', 'span']
 
-    STATEFUL_CLASSES = re.compile(r"\b(active|current|open|show|selected|aria-current)\b", re.I)
-    DROP_ATTRS = {"onclick", "onload", "style"}
-    KEEP_ATTRS = {"class", "role", "aria-label", "aria-labelledby", "href", "src", "id"}
+    STATEFUL_CLASSES = re.compile(r"\b(active|current|open|show|selected|collapsing|aria-current)\b", re.I)
+    WHITESPACE = re.compile(r"\s+")
+    # Characters lxml refuses to store in text or attributes (html.parser kept them as-is).
+    XML_INCOMPATIBLE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+    DROP_ATTRS = frozenset({"onclick", "onload", "style"})
+    KEEP_ATTRS = frozenset({"class", "role", "aria-label", "aria-labelledby", "href", "src", "id"})
+    FRAGMENT_ATTRS = frozenset({"href", "data-bs-target"})
+    INSTANCE_ATTRS = frozenset({"id", "aria-controls", "aria-expanded", "data-bs-toggle"})
 
     def __init__(self, src_dir: Path, out_dir: Path):
         self.src_dir = src_dir.resolve()
@@ -57,6 +68,7 @@ class HtmlRefactorer:
         self.out_dir.mkdir(parents=True, exist_ok=True)
         self.partials_dir.mkdir(exist_ok=True)
 
+        self._parse_files()
         self._extract_common_head_and_footer()
         # ❗ MODIFIED: Call the new tagging method
         self._mine_and_tag_candidates()
@@ -66,93 +78,107 @@ class HtmlRefactorer:
 
         print("\nRefactoring complete!")
 
-    def _to_zss_node(self, node):
-        label = node.name
-        if node.has_attr("class") and node["class"]:
-            label += ":" + ",".join(node["class"][:2])
-        z_node = Node(label)
-        for ch in node.children:
-            if isinstance(ch, Tag):
-                z_node.addkid(self._to_zss_node(ch))
-        return z_node
-
-    def _canonicalize(self, tag: Tag):
-        soup_copy = BeautifulSoup(str(tag), 'html.parser')
-        root_tag_in_copy = soup_copy.find(tag.name, recursive=False)
-
-        if not root_tag_in_copy:
+    @classmethod
+    def _canonicalize(cls, markup: str):
+        markup = cls.XML_INCOMPATIBLE.sub("", markup)
+        try:
+            root = fragment_fromstring(markup)
+        except etree.ParserError:
             return None
 
-        # Find and remove all comments first.
-        for comment in root_tag_in_copy.find_all(string=lambda text: isinstance(text, Comment)):
-            comment.extract()
-
-        for el in list(root_tag_in_copy.find_all(True)):
-            if el.has_attr("class"):
-                stateful = {"active", "show", "current", "open", "selected", "collapsing"}
-                cls = sorted([c for c in el["class"] if not self.STATEFUL_CLASSES.search(c) and c not in stateful])
-                if cls:
-                    el["class"] = cls
+        # Measure the size before comments go: stripping a comment merges the text on either side of it
+        # into one node, while _get_node_size counts those pieces separately.
+        node_size = cls._get_canonical_node_size(root)
+
+        # Find and remove all comments first, keeping the text that follows them. Markup without
+        # comment openers cannot contain any, so skip that extra walk over the tree.
+        if "<!--" in markup:
+            etree.strip_elements(root, etree.Comment, with_tail=False)
+
+        # This loop runs for every element of every candidate, so bind the lookups locally.
+        is_stateful = cls.STATEFUL_CLASSES.search
+        collapse_ws = cls.WHITESPACE.sub
+        fragment_attrs, instance_attrs = cls.FRAGMENT_ATTRS, cls.INSTANCE_ATTRS
+        drop_attrs, keep_attrs = cls.DROP_ATTRS, cls.KEEP_ATTRS
+
+        # Single pass over the elements: classes, attributes and text are all handled per element.
+        for el in root.iter(etree.Element):
+            attrib = el.attrib
+            if "class" in attrib:
+                classes = sorted(c for c in attrib["class"].split() if not is_stateful(c))
+                if classes:
+                    attrib["class"] = " ".join(classes)
                 else:
-                    if 'class' in el.attrs:
-                        del el['class']
-
-            attrs_to_normalize = {}
-            attrs_to_delete = []
-            for attr, value in el.attrs.items():
-                if attr in ["href", "data-bs-target"] and isinstance(value, str) and value.startswith("#"):
-                    attrs_to_normalize[attr] = "#"
-                elif attr in ["id", "aria-controls", "aria-expanded", "data-bs-toggle"]:
-                    attrs_to_delete.append(attr)
-                elif attr in self.DROP_ATTRS or (attr.startswith("data-") and attr not in self.KEEP_ATTRS):
-                    attrs_to_delete.append(attr)
-
-            for attr in attrs_to_delete:
-                if attr in el.attrs:
-                    del el.attrs[attr]
-            for attr, new_val in attrs_to_normalize.items():
-                el.attrs[attr] = new_val
-
-        # Process only the remaining NavigableString text nodes.
-        for t in root_tag_in_copy.find_all(string=True):
-            if isinstance(t, NavigableString):
-                nt = re.sub(r"\s+", " ", str(t)).strip()
-                if nt:
-                    t.replace_with(nt)
-                else:
-                    t.extract()
+                    del attrib["class"]
+
+            for attr, value in list(attrib.items()):
+                if attr in fragment_attrs and value.startswith("#"):
+                    attrib[attr] = "#"
+                elif attr in instance_attrs:
+                    del attrib[attr]
+                elif attr in drop_attrs or (attr.startswith("data-") and attr not in keep_attrs):
+                    del attrib[attr]
 
-        return root_tag_in_copy
+            # Normalize the text and tail nodes, dropping the ones left empty.
+            if el.text:
+                el.text = collapse_ws(" ", el.text).strip() or None
+            if el.tail:
+                el.tail = collapse_ws(" ", el.tail).strip() or None
+
+        return root, node_size
 
     def _get_node_size(self, tag: Tag):
         return len(tag.find_all(True)) + len(tag.find_all(string=lambda s: s and s.strip()))
 
-    def _get_minhash(self, tag: Tag):
+    @classmethod
+    def _get_canonical_node_size(cls, root):
+        # Same measure as _get_node_size on a tree that still holds its comments: descendant elements
+        # plus non-blank text pieces, where comment bodies are skipped but the text after them counts.
+        size = bool(root.text and root.text.strip())
+        for node in root.iterdescendants():
+            if isinstance(node.tag, str):
+                size += 1 + bool(node.text and node.text.strip())
+            size += bool(node.tail and node.tail.strip())
+        return size
+
+    @classmethod
+    def _get_minhash(cls, shingles):
         mh = MinHash(num_perm=128)
-        shingles = set()
-        for p in self._get_structural_paths(tag):
-            if len(p) >= 3:
-                for i in range(len(p) - 3 + 1):
-                    shingles.add(">".join(p[i:i + 3]))
-        for sh in shingles:
-            mh.update(sh.encode("utf-8"))
+        if shingles:
+            mh.update_batch(list(shingles))
         return mh
 
-    def _get_structural_paths(self, tag: Tag):
-        def get_paths(node, prefix=[]):
-            path = prefix + [node.name]
-            element_children = [c for c in node.children if isinstance(c, Tag)]
-            if not element_children:
-                yield path
-            else:
-                for child in element_children:
-                    yield from get_paths(child, path)
-
-        return get_paths(tag)
-
-    def _get_simhash(self, tag: Tag):
-        tokens = [el.name for el in tag.descendants if isinstance(el, Tag)]
-        return Simhash(tokens)
+    def _as_minhash(self, hashvalues):
+        # MinHashLSH only reads the hash values, so skip MinHash's permutation setup.
+        return LeanMinHash(seed=1, hashvalues=hashvalues)
+
+    @classmethod
+    def _get_structural_features(cls, tag):
+        # Each node below depth 2 ends exactly one path trigram, so a single walk that
+        # carries the two nearest ancestor names yields every root-to-leaf path shingle.
+        # Shingles are built as bytes so they can be fed to MinHash without re-encoding.
+        # The same walk counts descendant tag names for the SimHash.
+        encoded_names = {}
+        shingles = set()
+        name_counts = Counter()
+        stack = [(tag, None, None)]
+        while stack:
+            node, parent, grandparent = stack.pop()
+            name = encoded_names.get(node.tag)
+            if name is None:
+                name = encoded_names[node.tag] = node.tag.encode("utf-8")
+            if parent is not None:
+                name_counts[node.tag] += 1
+                if grandparent is not None:
+                    shingles.add(b">".join((grandparent, parent, name)))
+            for child in node.iterchildren(etree.Element):
+                stack.append((child, name, parent))
+        return shingles, name_counts
+
+    @classmethod
+    def _get_simhash(cls, name_counts):
+        # Weighted features hash each distinct tag name once instead of once per occurrence.
+        return Simhash(name_counts)
 
     def _longest_common_suffix(self, strings):
         if not strings: return ""
@@ -167,33 +193,58 @@ class HtmlRefactorer:
                 break
         return "".join(reversed(suffix))
 
-    def _extract_common_head_and_footer(self):
-        print("\nExtracting global head/footer partials...")
+    def _parse_files(self):
         html_files = sorted(self.src_dir.rglob("*.html"))
         self.all_html_files = [f.resolve() for f in html_files]
 
-        titles = []
+        # Parse each page exactly once; later phases read and mutate these soups.
+        for p in self.all_html_files:
+            try:
+                soup = BeautifulSoup(p.read_text(encoding="utf-8", errors="ignore"), "lxml")
+                # Unlike html5lib, lxml does not add a missing <html>, <head> or <body>. Add empty ones so
+                # such pages still count in the head/footer intersections and receive the includes.
+                if not soup.html:
+                    soup.append(soup.new_tag("html"))
+                if not soup.head:
+                    soup.html.insert(0, soup.new_tag("head"))
+                if not soup.body:
+                    soup.html.append(soup.new_tag("body"))
+                self.soups[p] = soup
+            except Exception as e:
+                print(f"Could not parse {p}: {e}")
+
+    def _fingerprint(self, tag, representatives):
+        # Short digest keys keep the per-file sets small; the markup is kept once for output.
+        html = str(tag)
+        key = hashlib.blake2b(html.encode("utf-8"), digest_size=16).digest()
+        representatives.setdefault(key, html)
+        return key
+
+    def _extract_common_head_and_footer(self):
+        print("\nExtracting global head/footer partials...")
+        titles = {}
         meta_sets, link_sets, style_sets, head_script_sets = [], [], [], []
         rep_meta, rep_link, rep_style, rep_script = {}, {}, {}, {}
 
-        for p in self.all_html_files:
-            soup = BeautifulSoup(p.read_text(encoding="utf-8", errors="ignore"), "html5lib")
+        for p, soup in self.soups.items():
             head = soup.head
             if not head: continue
 
-            t = head.find("title").string.strip() if head.find("title") and head.find("title").string else ""
-            titles.append(t)
-            metas = {str(m) for m in head.find_all("meta") if not m.get("charset")}
-            rep_meta.update({str(m): str(m) for m in head.find_all("meta")})
+            # Collect every tag we care about in a single walk over the head
+            head_tags = defaultdict(list)
+            for tag in head.find_all(["title", "meta", "link", "style", "script"]):
+                head_tags[tag.name].append(tag)
+
+            title = head_tags["title"][0] if head_tags["title"] else None
+            t = title.string.strip() if title and title.string else ""
+            titles[p] = t
+            metas = {self._fingerprint(m, rep_meta) for m in head_tags["meta"] if not m.get("charset")}
             meta_sets.append(metas)
-            links = {str(l) for l in head.find_all("link") if l.get("rel") != ["stylesheet"]}
-            rep_link.update({str(l): str(l) for l in head.find_all("link")})
+            links = {self._fingerprint(l, rep_link) for l in head_tags["link"] if l.get("rel") != ["stylesheet"]}
             link_sets.append(links)
-            styles = {str(s) for s in head.find_all("style")}
-            rep_style.update({str(s): str(s) for s in head.find_all("style")})
+            styles = {self._fingerprint(s, rep_style) for s in head_tags["style"]}
             style_sets.append(styles)
-            h_scripts = {str(s) for s in head.find_all("script") if s.get("src") or s.string}
-            rep_script.update({str(s): str(s) for s in head.find_all("script")})
+            h_scripts = {self._fingerprint(s, rep_script) for s in head_tags["script"] if s.get("src") or s.string}
             head_script_sets.append(h_scripts)
 
         common_metas = set.intersection(*meta_sets) if meta_sets else set()
@@ -201,32 +252,31 @@ class HtmlRefactorer:
         common_styles = set.intersection(*style_sets) if style_sets else set()
         common_head_scripts = set.intersection(*head_script_sets) if head_script_sets else set()
 
-        common_suffix = self._longest_common_suffix(titles)
+        common_suffix = self._longest_common_suffix(list(titles.values()))
         title_line = "<title>{{ page_title }}</title>"
         if common_suffix:
             title_line = f"<title>{{{{ page_title }}}} {common_suffix}</title>"
 
         self.page_titles = {
             str(p): (t[:len(t) - len(common_suffix)].strip(" |-") if common_suffix else t)
-            for p, t in zip(self.all_html_files, titles)
+            for p, t in titles.items()
         }
 
-        lines = [title_line] + [rep_meta[m] for m in sorted(common_metas)] + [rep_link[l] for l in sorted(common_links)]
+        lines = [title_line] + sorted(rep_meta[m] for m in common_metas) + sorted(rep_link[l] for l in common_links)
         write_partial(self.partials_dir, "title-meta.html", "\n".join(lines))
 
         css_lines = []
-        if self.all_html_files:
-            first_soup = BeautifulSoup(self.all_html_files[0].read_text(encoding="utf-8", errors="ignore"), "html5lib")
+        if self.soups:
+            first_soup = next(iter(self.soups.values()))
             if first_soup.head:
                 for l in first_soup.head.find_all("link", rel="stylesheet"):
                     css_lines.append(str(l))
-        css_lines += [rep_style[s] for s in sorted(common_styles)]
-        css_lines += [rep_script[s] for s in sorted(common_head_scripts)]
+        css_lines += sorted(rep_style[s] for s in common_styles)
+        css_lines += sorted(rep_script[s] for s in common_head_scripts)
         write_partial(self.partials_dir, "head-css.html", "\n".join(css_lines))
 
         all_script_sets, rep_script_footer = [], {}
-        for p in self.all_html_files:
-            soup = BeautifulSoup(p.read_text(encoding="utf-8", errors="ignore"), "html5lib")
+        for soup in self.soups.values():
             body = soup.body
             if not body: continue
             srcs = set()
@@ -243,9 +293,9 @@ class HtmlRefactorer:
     def _mine_and_tag_candidates(self):
         print("\n[1/4] 🔍 Mining and tagging candidate components...")
         idx = 0
-        for html_path in self.all_html_files:
+        pending = []
+        for html_path, soup in self.soups.items():
             try:
-                soup = BeautifulSoup(html_path.read_text(encoding="utf-8", errors="ignore"), "html5lib")
                 body = soup.body or soup
                 found_tags = set()
 
@@ -258,32 +308,65 @@ class HtmlRefactorer:
                     if self._get_node_size(el) >= self.MIN_NODE_COUNT:
                         found_tags.add(el)
 
+                candidates = []
                 for tag in found_tags:
                     key = f"c_{idx}"
                     tag['data-refactor-id'] = key
-
+                    idx += 1
                     # Capture the original, raw HTML of the tag
-                    raw_tag_html = str(tag)
+                    candidates.append((key, str(tag)))
+                if candidates:
+                    pending.append((html_path, candidates))
 
-                    # Create a copy for canonicalization, leaving original tag unmodified
-                    tag_copy = BeautifulSoup(raw_tag_html, "html5lib").find(tag.name)
-                    if tag_copy and tag_copy.has_attr('data-refactor-id'):
-                        del tag_copy['data-refactor-id']
+            except Exception as e:
+                print(f"Could not process {html_path}: {e}")
 
-                    canonical_tag = self._canonicalize(tag_copy)
-                    if canonical_tag:
-                        mh = self._get_minhash(canonical_tag)
-                        simh = self._get_simhash(canonical_tag)
-                        self.lsh.insert(key, mh)
-                        # Store the raw_tag_html along with the canonical_tag
-                        self.items[key] = (html_path, raw_tag_html, canonical_tag, mh, simh)
-                        idx += 1
+        # Canonicalizing and hashing only need the raw markup, so each file's candidates go to a worker
+        # process while the tagged soups stay here for the replacement step.
+        # Index inserts are batched in an insertion session; keys are unique by construction.
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor, self.lsh.insertion_session() as session:
+            futures = [
+                (html_path, candidates, executor.submit(self._analyze_candidates, candidates))
+                for html_path, candidates in pending
+            ]
+            for html_path, candidates, future in futures:
+                try:
+                    results = future.result()
+                except Exception as e:
+                    print(f"Could not process {html_path}: {e}")
+                    continue
 
-                self.soups[html_path] = soup
+                for (key, raw_tag_html), result in zip(candidates, results):
+                    if result is None:
+                        continue
+                    hashvalues, simhash_value, node_size = result
+                    session.insert(key, self._as_minhash(hashvalues), check_duplication=False)
+                    # Store the raw_tag_html along with the bare MinHash and SimHash values and the cached node size
+                    self.items[key] = (html_path, raw_tag_html, hashvalues, simhash_value, node_size)
+        print(f"Found and tagged {len(self.items)} candidates.")
 
+    @classmethod
+    def _analyze_candidates(cls, candidates):
+        results = []
+        for key, raw_tag_html in candidates:
+            # A failing candidate is dropped on its own so the rest of its page is still mined
+            try:
+                # Canonicalization builds its own lxml copy and drops data-refactor-id with the other data- attributes
+                canonical = cls._canonicalize(raw_tag_html)
+                if canonical is None:
+                    results.append(None)
+                    continue
+                canonical_tag, node_size = canonical
+                shingles, name_counts = cls._get_structural_features(canonical_tag)
+                results.append((
+                    cls._get_minhash(shingles).hashvalues,
+                    cls._get_simhash(name_counts).value,
+                    node_size,
+                ))
             except Exception as e:
-                print(f"Could not process {html_path}: {e}")
-        print(f"Found and tagged {len(self.items)} candidates.")
+                print(f"Could not process candidate {key}: {e}")
+                results.append(None)
+        return results
 
     def _cluster_candidates(self):
         print("\nClustering...")
@@ -293,10 +376,10 @@ class HtmlRefactorer:
             if key in visited:
                 continue
 
-            # Unpack 5 items instead of 4 to account for raw_tag_html
-            _, _, seed_tag, seed_mh, seed_simh = self.items[key]
+            # Unpack 5 items to account for raw_tag_html and the cached node size
+            _, _, seed_hashvalues, seed_simh, n1 = self.items[key]
 
-            near_keys = self.lsh.query(seed_mh)
+            near_keys = self.lsh.query(self._as_minhash(seed_hashvalues))
             cluster = [(key, self.items[key])]
             visited.add(key)
 
@@ -305,13 +388,14 @@ class HtmlRefactorer:
                     continue
 
                 # Unpack 5 items here as well
-                _, _, near_tag, _, near_simh = self.items[nk]
+                _, _, _, near_simh, n2 = self.items[nk]
 
-                if seed_simh.distance(near_simh) > self.SIMHASH_DISTANCE:
+                # Check the cached node sizes first, it is the cheaper filter
+                if n1 > 0 and n2 > 0 and min(n1, n2) / max(n1, n2) < self.NODE_COUNT_SIMILARITY:
                     continue
 
-                n1, n2 = self._get_node_size(seed_tag), self._get_node_size(near_tag)
-                if n1 > 0 and n2 > 0 and min(n1, n2) / max(n1, n2) < self.NODE_COUNT_SIMILARITY:
+                # Hamming distance between the 64-bit SimHash values
+                if (seed_simh ^ near_simh).bit_count() > self.SIMHASH_DISTANCE:
                     continue
 
                 cluster.append((nk, self.items[nk]))
@@ -328,11 +412,7 @@ class HtmlRefactorer:
         for i, cluster in enumerate(self.clusters):
             medoid_key, medoid_data = cluster[0]
             # Unpack the new data structure including the raw html
-            medoid_path, medoid_raw_html, medoid_tag, _, _ = medoid_data
-
-            if not medoid_tag or not hasattr(medoid_tag, 'name'):
-                print(f"   ⚠️  Skipping invalid cluster {i + 1} (medoid was empty).")
-                continue
+            medoid_path, medoid_raw_html, _, _, _ = medoid_data
 
             # Use the pristine, raw HTML to create the partial
             partial_soup = BeautifulSoup(medoid_raw_html, 'html.parser')
@@ -349,7 +429,8 @@ class HtmlRefactorer:
             cluster_instances = []
             # Adjust unpacking for the loop
             for key, (path, _, _, _, _) in cluster:
-                cluster_instances.append({"refactor_id": key, "source_file": str(path)})
+                # Keep the resolved Path so replacement can group instances without re-resolving
+                cluster_instances.append({"refactor_id": key, "source_file": path})
 
             final_clusters_info.append({
                 "partial_file": partial_name,
@@ -361,50 +442,66 @@ class HtmlRefactorer:
     def _replace_in_files(self):
         print("\nReplacing HTML with import statements...")
 
-        for p, soup in self.soups.items():
-            head, body = soup.head, soup.body
-
-            # Replace cluster instances by refactor-id
-            for cluster in self.clusters:
-                include_stmt = create_include_statement(cluster["partial_file"])
-                for inst in cluster["instances"]:
-                    # Process only instances belonging to the current file
-                    if Path(inst["source_file"]).resolve() == p:
-                        ref_id = inst["refactor_id"]
-                        target = soup.find(attrs={"data-refactor-id": ref_id})
-                        if target:
-                            target.replace_with(BeautifulSoup(include_stmt, "html.parser"))
-
-            # HEAD replacement
-            if head:
-                # Clear existing head tags that will be replaced by partials
-                for tag_type in ["title", "meta", "link", "style", "script"]:
-                    for tag in head.find_all(tag_type):
-                        # A bit more careful decomposition
-                        if tag_type == "link" and tag.get("rel") == ["stylesheet"]:
-                            tag.decompose()
-                        elif tag_type != "link":
+        # Include statements are plain text, so they are built once and inserted as strings
+        # instead of being run through an HTML parser for every insertion.
+        instances_by_file = defaultdict(list)
+        for cluster in self.clusters:
+            include_stmt = create_include_statement(cluster["partial_file"])
+            for inst in cluster["instances"]:
+                instances_by_file[inst["source_file"]].append((include_stmt, inst))
+        head_css_include = create_include_statement("head-css.html")
+        footer_scripts_include = create_include_statement("footer-scripts.html")
+
+        # Pages are written from a thread pool so disk I/O overlaps with rewriting the next page.
+        with ThreadPoolExecutor(max_workers=8) as writer:
+            writes = []
+            for p, soup in self.soups.items():
+                head, body = soup.head, soup.body
+
+                # Replace cluster instances belonging to the current file by refactor-id
+                file_instances = instances_by_file.get(p, [])
+                if file_instances:
+                    tags_by_id = {t["data-refactor-id"]: t for t in soup.find_all(attrs={"data-refactor-id": True})}
+                for include_stmt, inst in file_instances:
+                    target = tags_by_id.get(inst["refactor_id"])
+                    # Skip targets that were detached along with an already replaced ancestor
+                    if target and any(parent is soup for parent in target.parents):
+                        target.replace_with(NavigableString(include_stmt))
+
+                # HEAD replacement
+                if head:
+                    # Clear existing head tags that will be replaced by partials
+                    for tag_type in ["title", "meta", "link", "style", "script"]:
+                        for tag in head.find_all(tag_type):
+                            # A bit more careful decomposition
+                            if tag_type == "link" and tag.get("rel") == ["stylesheet"]:
+                                tag.decompose()
+                            elif tag_type != "link":
+                                tag.decompose()
+
+                    page_title = self.page_titles.get(str(p), "")
+                    title_meta_include = create_include_statement(
+                        "title-meta.html",
+                        {"page_title": page_title} if page_title else None
+                    )
+                    head.insert(0, NavigableString(title_meta_include))
+                    head.append(NavigableString(head_css_include))
+
+                # FOOTER replacement
+                if body:
+                    for tag in body.find_all("script", src=True):
+                        if tag.get("src") in self.common_js_srcs:
                             tag.decompose()
+                    body.append(NavigableString(footer_scripts_include))
+
+                out_path = self.out_dir / p.relative_to(self.src_dir)
+                out_path.parent.mkdir(parents=True, exist_ok=True)
+                writes.append((p, writer.submit(write_page, out_path, soup)))
 
-                page_title = self.page_titles.get(str(p), "")
-                title_meta_include = create_include_statement(
-                    "title-meta.html",
-                    {"page_title": page_title} if page_title else None
-                )
-                head.insert(0, BeautifulSoup(title_meta_include, "html.parser"))
-                head.append(BeautifulSoup("@@include('./partials/head-css.html')", "html.parser"))
-
-            # FOOTER replacement
-            if body:
-                for tag in body.find_all("script", src=True):
-                    if tag.get("src") in self.common_js_srcs:
-                        tag.decompose()
-                body.append(BeautifulSoup("@@include('./partials/footer-scripts.html')", "html.parser"))
-
-            out_path = self.out_dir / p.relative_to(self.src_dir)
-            out_path.parent.mkdir(parents=True, exist_ok=True)
-            out_path.write_text(soup.prettify(), encoding="utf-8")
-            print(f"   Updated {p.relative_to(self.src_dir)}")
+            # Report each page only once its write has actually succeeded
+            for p, future in writes:
+                future.result()
+                print(f"   Updated {p.relative_to(self.src_dir)}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,22 @@
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from main import HtmlRefactorer
+
+
+class CanonicalizeTest(unittest.TestCase):
+    def test_control_characters_in_text_and_class(self):
+        markup = '<footer class="ft\x01 x"><p>Copy\x1bright\x08</p><p>a \x0b b</p></footer>'
+        canonical = HtmlRefactorer._canonicalize(markup)
+        self.assertIsNotNone(canonical)
+        root, node_size = canonical
+        self.assertEqual(root.get("class"), "ft x")
+        self.assertEqual([p.text for p in root], ["Copyright", "a b"])
+        self.assertEqual(node_size, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()